@@ -1,7 +1,9 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 from sqlalchemy import create_engine, text
 from dotenv import load_dotenv
+from query_cache import cached
 
 # Loading environment variables from .env file
 load_dotenv()
@@ -19,22 +21,55 @@ url_string = f"mysql+pymysql://{sql_username}:{sql_password}@{sql_host}:3306/{sq
 
 TABLE = "research_experiment_refactor_test"
 
-# Creating engine
-engine = create_engine(url_string)
-
-def preview_table():
+# Creating engine (pooled connections are pinged before use and recycled
+# every 30 min so a warm pool survives MySQL's idle timeout; sized for the
+# parallel data quality queries plus the shared connection)
+engine = create_engine(
+    url_string,
+    pool_pre_ping=True,
+    pool_size=8,
+    pool_recycle=1800,
+)
+
+# Query results are cached in .qcache/ (see query_cache.py), keyed by the
+# SQL text + params
+def cached_read_sql(query, con, params=None):
+    return cached(
+        lambda: pd.read_sql(query, con, params=params),
+        str(query),
+        sorted(params.items()) if params else None,
+    )
+
+def preview_table(conn):
     print("\n=== Testing Connection: Showing First 50 Rows ===")
-    query = "SELECT * FROM research_experiment_refactor_test LIMIT 50"
-    df = pd.read_sql(query, engine)
-    print(df.head())
-    return df
+    query = f"SELECT * FROM {TABLE} LIMIT 50"
+
+    # Smoke test only, so print straight from the cursor instead of
+    # building a DataFrame just to show its head
+    result = conn.exec_driver_sql(query)
+    columns = list(result.keys())
+    rows = result.fetchmany(50)
+
+    print(" | ".join(columns))
+    for row in rows[:5]:
+        print(" | ".join(str(v) for v in row))
+    return rows
+
+# Runs independent read-only queries concurrently, each on its own pooled
+# connection; the threads spend their time waiting on MySQL, not the GIL
+def read_sql_parallel(queries, max_workers=6):
+    with ThreadPoolExecutor(max_workers=max_workers) as ex:
+        futures = {
+            name: ex.submit(cached_read_sql, q, engine)
+            for name, q in queries.items()
+        }
+        return {name: f.result() for name, f in futures.items()}
 
 def data_quality_assessment():
     print("\n=== DATA QUALITY ASSESSMENT (Part 1.2) ===")
 
     # 1. Unique athletes
     q1 = f"SELECT COUNT(DISTINCT playername) AS unique_players FROM {TABLE}"
-    print("Unique athletes:", pd.read_sql(q1, engine).iloc[0, 0])
 
     # 2. Unique teams
     q2 = f"""
@@ -42,12 +77,9 @@ def data_quality_assessment():
         FROM {TABLE}
         WHERE team IS NOT NULL AND team <> ''
     """
-    print("Unique teams:", pd.read_sql(q2, engine).iloc[0, 0])
 
     # 3. Date range
     q3 = f"SELECT MIN(timestamp) AS earliest, MAX(timestamp) AS latest FROM {TABLE}"
-    print("\nDate range:")
-    print(pd.read_sql(q3, engine))
 
     # 4. Data source record counts
     q4 = f"""
@@ -56,8 +88,6 @@ def data_quality_assessment():
         GROUP BY data_source
         ORDER BY count DESC
     """
-    print("\nRecord count by data source:")
-    print(pd.read_sql(q4, engine))
 
     # 5. Invalid names
     q5 = f"""
@@ -68,12 +98,6 @@ def data_quality_assessment():
            OR UPPER(playername) = 'UNKNOWN'
         GROUP BY playername
     """
-    invalid = pd.read_sql(q5, engine)
-    print("\nInvalid names:")
-    if invalid.empty:
-        print("None")
-    else:
-        print(invalid)
 
     # 6. Players with data from multiple sources
     q6 = f"""
@@ -84,82 +108,98 @@ def data_quality_assessment():
         HAVING source_count >= 2
         ORDER BY source_count DESC
     """
-    multi = pd.read_sql(q6, engine)
-    print("\nAthletes with ≥2 data sources:", len(multi))
-    print(multi.head(10))
 
-def metric_discovery():
-    print("\n=== METRIC DISCOVERY (Part 1.3) ===")
+    results = read_sql_parallel(
+        {"q1": q1, "q2": q2, "q3": q3, "q4": q4, "q5": q5, "q6": q6}
+    )
 
-    def top_metrics(source):
-        q = f"""
-            SELECT metric, COUNT(*) AS count
-            FROM {TABLE}
-            WHERE data_source = '{source}'
-            GROUP BY metric
-            ORDER BY count DESC
-            LIMIT 10
-        """
-        df = pd.read_sql(q, engine)
-        print(f"\nTop 10 metrics for {source}:")
-        print(df)
-        return df
-
-    hawkins_top = top_metrics("hawkins")   
-    kinexon_top = top_metrics("kinexon")
-    vald_top    = top_metrics("vald")
+    print("Unique athletes:", results["q1"].iloc[0, 0])
+    print("Unique teams:", results["q2"].iloc[0, 0])
 
-    # Total unique metrics across all sources
-    q_unique = f"""
-        SELECT COUNT(DISTINCT metric) AS unique_metrics
-        FROM {TABLE}
-    """
-    unique_df = pd.read_sql(q_unique, engine)
-    print("\nTotal unique metrics across all sources:")
-    print(unique_df)
+    print("\nDate range:")
+    print(results["q3"])
 
-# For each data source, show date range + record count for TOP metrics
-    def metric_summary_for_source(source, top_df):
-        if top_df.empty:
-            return None
+    print("\nRecord count by data source:")
+    print(results["q4"])
 
-        # Build a safe IN (...) list with proper quoting and escaping
-        metrics = top_df["metric"].tolist()
+    invalid = results["q5"]
+    print("\nInvalid names:")
+    if invalid.empty:
+        print("None")
+    else:
+        print(invalid)
 
-        # Escape single quotes and % for each metric name
-        escaped_metrics = [
-            m.replace("'", "''").replace("%", "%%") for m in metrics
-        ]
+    multi = results["q6"]
+    print("\nAthletes with ≥2 data sources:", len(multi))
+    print(multi.head(10))
 
-        # Build: ('metric1','metric2',...)
-        metrics_sql = "(" + ",".join(f"'{m}'" for m in escaped_metrics) + ")"
+def metric_discovery(conn):
+    print("\n=== METRIC DISCOVERY (Part 1.3) ===")
 
-        q = f"""
+    sources = ["hawkins", "kinexon", "vald"]
+    sources_sql = "(" + ",".join(f"'{src}'" for src in sources) + ")"
+
+    # Top 10 metrics per source, with their record count and date range,
+    # ranked in one grouped query instead of one query per source per step
+    q_top = f"""
+        SELECT data_source, metric, record_count, earliest_date, latest_date
+        FROM (
             SELECT
+                LOWER(data_source) AS data_source,
                 metric,
                 COUNT(*) AS record_count,
                 MIN(timestamp) AS earliest_date,
-                MAX(timestamp) AS latest_date
+                MAX(timestamp) AS latest_date,
+                ROW_NUMBER() OVER (
+                    PARTITION BY LOWER(data_source)
+                    ORDER BY COUNT(*) DESC
+                ) AS rn
             FROM {TABLE}
-            WHERE data_source = '{source}'
-              AND metric IN {metrics_sql}
-            GROUP BY metric
-            ORDER BY record_count DESC;
-        """
+            WHERE data_source IN {sources_sql}
+            GROUP BY LOWER(data_source), metric
+        ) ranked
+        WHERE rn <= 10
+        ORDER BY data_source, record_count DESC
+    """
+    top_df = cached_read_sql(q_top, conn)
+
+    top_by_source = {
+        src: top_df[top_df["data_source"] == src]
+                .drop(columns="data_source")
+                .reset_index(drop=True)
+        for src in sources
+    }
+
+    for src in sources:
+        print(f"\nTop 10 metrics for {src}:")
+        print(
+            top_by_source[src][["metric", "record_count"]]
+            .rename(columns={"record_count": "count"})
+        )
 
-        df = pd.read_sql(q, engine)
-        print(f"\nDate Range + Record Count for Top Metrics ({source}):")
-        print(df)
-        return df
+    # Total unique metrics across all sources
+    q_unique = f"""
+        SELECT COUNT(DISTINCT metric) AS unique_metrics
+        FROM {TABLE}
+    """
+    unique_df = cached_read_sql(q_unique, conn)
+    print("\nTotal unique metrics across all sources:")
+    print(unique_df)
 
-    hawkins_summary = metric_summary_for_source("hawkins", hawkins_top)
-    kinexon_summary = metric_summary_for_source("kinexon", kinexon_top)
-    vald_summary    = metric_summary_for_source("vald", vald_top)
+    # For each data source, show date range + record count for TOP metrics
+    for src in sources:
+        if top_by_source[src].empty:
+            continue
+        print(f"\nDate Range + Record Count for Top Metrics ({src}):")
+        print(top_by_source[src])
 
 if __name__ == "__main__":
-    preview_table()
-    data_quality_assessment()
-    metric_discovery()
+    # One connection shared by the sequential queries in the run;
+    # data_quality_assessment fans out over the pool instead
+    with engine.connect() as conn:
+        preview_table(conn)
+        data_quality_assessment()
+        metric_discovery(conn)
 
     engine.dispose()
     print("\nDone.")
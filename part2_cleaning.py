@@ -3,9 +3,12 @@
 # ================================================================
 
 import os
+import functools
 import pandas as pd
-from sqlalchemy import create_engine, text
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import create_engine, text, bindparam
 from dotenv import load_dotenv
+from query_cache import cache_path, read_cached, write_cached
 
 # ------------------------------------------------
 # LOAD ENVIRONMENT VARIABLES + CONNECT TO DATABASE
@@ -27,8 +30,13 @@ url_string = f"mysql+pymysql://{sql_username}:{sql_password}@{sql_host}:3306/{sq
 # Table name
 TABLE = "research_experiment_refactor_test"
 
-# Connect
-engine = create_engine(url_string)
+# Connect (same pool settings as Part 1)
+engine = create_engine(
+	url_string,
+	pool_pre_ping=True,
+	pool_size=4,
+	pool_recycle=1800,
+)
 
 print(f"\nConnected successfully to database: {sql_database}")
 print(f"Using table: {TABLE}")
@@ -39,6 +47,8 @@ print(f"Using table: {TABLE}")
 
 VALUE_COL = "value"  # numeric column
 
+CHUNK_SIZE = 10000  # rows per fetch for bulk reads
+
 SELECTED_METRICS = [
 	"Jump Height (m)",           # Hawkins
 	"Peak Propulsive Power (W)", # Hawkins
@@ -49,23 +59,86 @@ SELECTED_METRICS = [
 ]
 
 # ------------------------------------------------
-# HELPER: Build SQL-safe
+# HELPER: Bind the metric list instead of inlining it
 # ------------------------------------------------
 
-def _build_metrics_in_clause(metrics):
-	escaped = [m.replace("'", "''").replace("%", "%%") for m in metrics]
-	return "(" + ",".join(f"'{m}'" for m in escaped) + ")"
+# Expanding bind param: the driver quotes each metric, and every query keeps
+# the same parameterized shape whatever list is passed in
+METRICS_PARAM = bindparam("metrics", expanding=True)
+
+@functools.lru_cache(maxsize=32)
+def _metrics_query(sql):
+	return text(sql).bindparams(METRICS_PARAM)
 
 # ------------------------------------------------
-# 2.1 – MISSING DATA ANALYSIS
+# HELPER: Low-cardinality string columns -> category
 # ------------------------------------------------
 
-def missing_data_analysis(selected_metrics):
-	print("\n===== PART 2.1 — Missing Data Analysis =====")
+def _as_category(df, columns=("team", "playername", "metric")):
+	# groupby/merge/pivot then hash small integer codes, not Python strings
+	for c in columns:
+		if c in df.columns:
+			df[c] = df[c].astype("category")
+	return df
+
+# ------------------------------------------------
+# HELPER: Stream bulk reads
+# ------------------------------------------------
 
-	metrics_sql = _build_metrics_in_clause(selected_metrics)
+def _read_sql_streamed(query, conn, params=None, parse_dates=None):
+	# Server-side cursor: rows come over in CHUNK_SIZE batches instead of
+	# being buffered all at once by the driver before the DataFrame is built.
+	# Each chunk is Arrow-backed, so its strings sit in compact Arrow buffers
+	# rather than one Python object per cell while the chunks are concatenated
+	if isinstance(query, str):
+		query = text(query)
+	query = query.execution_options(
+		stream_results=True, max_row_buffer=CHUNK_SIZE
+	)
+	chunks = pd.read_sql(
+		query,
+		conn,
+		params=params,
+		chunksize=CHUNK_SIZE,
+		parse_dates=parse_dates,
+		dtype_backend="pyarrow",
+	)
+	return pd.concat(chunks, ignore_index=True)
 
-	# 1. Missing + zero counts
+# ------------------------------------------------
+# SHARED: PER (TEAM, PLAYER, METRIC) COVERAGE
+# ------------------------------------------------
+
+def load_coverage(selected_metrics, conn):
+	# Counts + last test date aggregated in MySQL, so only this small summary
+	# comes back; 2.1 reports on it and 2.2 picks its sample players from it
+	q_counts = f"""
+		SELECT
+			team,
+			playername,
+			metric,
+			COUNT(*) AS n_measurements,
+			MAX(timestamp) AS last_test
+		FROM {TABLE}
+		WHERE metric IN :metrics
+		  AND playername IS NOT NULL AND TRIM(playername) <> ''
+		  AND team IS NOT NULL AND TRIM(team) <> ''
+		GROUP BY team, playername, metric;
+	"""
+	coverage = pd.read_sql(
+		_metrics_query(q_counts),
+		conn,
+		params={"metrics": list(selected_metrics)},
+		parse_dates=["last_test"],
+	)
+	return _as_category(coverage)
+
+# ------------------------------------------------
+# 2.1 – MISSING DATA ANALYSIS
+# ------------------------------------------------
+
+def load_missing_counts(selected_metrics, conn):
+	# Missing + zero counts per metric
 	q_missing = f"""
 		SELECT
 			metric,
@@ -73,38 +146,37 @@ def missing_data_analysis(selected_metrics):
 			SUM(CASE WHEN {VALUE_COL} = 0 THEN 1 ELSE 0 END) AS zero_count,
 			COUNT(*) AS total_rows
 		FROM {TABLE}
-		WHERE metric IN {metrics_sql}
+		WHERE metric IN :metrics
 		GROUP BY metric
 		ORDER BY (null_count + zero_count) DESC;
 	"""
-	missing_df = pd.read_sql(q_missing, engine)
+	return pd.read_sql(
+		_metrics_query(q_missing), conn, params={"metrics": list(selected_metrics)}
+	)
+
+def missing_data_analysis(missing_df, coverage):
+	print("\n===== PART 2.1 — Missing Data Analysis =====")
+
+	# 1. Missing + zero counts
 	print("\nNULL + ZERO counts by metric:")
 	print(missing_df)
 
-	# 2. % of athletes per team with >= 5 measurements
-	q_team = f"""
-		SELECT playername, team, metric, timestamp, {VALUE_COL} AS value
-		FROM {TABLE}
-		WHERE metric IN {metrics_sql}
-		  AND playername IS NOT NULL AND TRIM(playername) <> ''
-		  AND team IS NOT NULL AND TRIM(team) <> '';
-	"""
-	df = pd.read_sql(q_team, engine)
-
-	if df.empty:
+	# 2. Coverage per (team, player, metric), shared with Part 2.2
+	if coverage.empty:
 		print("\nNo rows found for these metrics!")
 		return
 
+	# % of athletes per team with >= 5 measurements; counts has one row per
+	# (team, player), so total_athletes is a group size, not a nunique
 	counts = (
-		df.groupby(["team", "playername"])
-		  .size()
-		  .reset_index(name="n_measurements")
+		coverage.groupby(["team", "playername"], observed=True)["n_measurements"]
+		   .sum()
 	)
-	counts["has_5_plus"] = counts["n_measurements"] >= 5
 
-	team_summary = counts.groupby("team").agg(
-		total_athletes=("playername", "nunique"),
-		athletes_ge5=("has_5_plus", "sum")
+	team_summary = (
+		(counts >= 5)
+		   .groupby(level="team", observed=True)
+		   .agg(total_athletes="size", athletes_ge5="sum")
 	)
 	team_summary["pct_with_5_plus"] = (
 		team_summary["athletes_ge5"] / team_summary["total_athletes"] * 100
@@ -114,93 +186,140 @@ def missing_data_analysis(selected_metrics):
 	print(team_summary)
 
 	# 3. Not tested in last 6 months
-	df["timestamp"] = pd.to_datetime(df["timestamp"])
-	last_test = df.groupby("playername")["timestamp"].max().reset_index()
+	last_test = (
+		coverage.groupby("playername", observed=True)["last_test"]
+		   .max()
+		   .reset_index()
+	)
 	cutoff = pd.Timestamp.today() - pd.DateOffset(months=6)
 
-	inactive = last_test[last_test["timestamp"] < cutoff]
+	inactive = last_test[last_test["last_test"] < cutoff]
 
-	# add team
-	latest_team = (
-		df.sort_values("timestamp")
-		  .drop_duplicates("playername", keep="last")[["playername", "team"]]
-	)
+	# add team (row of each player's latest test, no full sort needed)
+	dated = coverage.dropna(subset=["last_test"])
+	latest_idx = dated.groupby("playername", observed=True)["last_test"].idxmax()
+	latest_team = dated.loc[latest_idx, ["playername", "team"]]
 	inactive = inactive.merge(latest_team, on="playername", how="left")
 
 	print(f"\nAthletes not tested since {cutoff.date()}:")
-	print(inactive)
+	print(inactive.rename(columns={"last_test": "timestamp"}))
 
 	# 4. Data sufficiency
+	rows_per_athlete = (
+		coverage.groupby("playername", observed=True)["n_measurements"].sum()
+	)
 	print("\nData sufficiency:")
-	print(f"Total rows for selected metrics: {len(df)}")
-	print(f"Total athletes: {df['playername'].nunique()}")
-	print(f"Median rows per athlete: {df.groupby('playername').size().median():.2f}")
+	print(f"Total rows for selected metrics: {rows_per_athlete.sum()}")
+	print(f"Total athletes: {len(rows_per_athlete)}")
+	print(f"Median rows per athlete: {rows_per_athlete.median():.2f}")
 
 # ------------------------------------------------
 # 2.2 — LONG → WIDE TRANSFORMATION
 # ------------------------------------------------
 
-def long_to_wide_for_player(player_name, selected_metrics):
-	metrics_sql = _build_metrics_in_clause(selected_metrics)
-
-	q = f"""
-		SELECT timestamp, metric, {VALUE_COL} AS value
-		FROM {TABLE}
-		WHERE playername = :p
-		  AND metric IN {metrics_sql}
-		ORDER BY timestamp;
-	"""
-	df = pd.read_sql(text(q), engine, params={"p": player_name})
-
-	if df.empty:
-		print(f"\nNo data for player {player_name}.")
-		return pd.DataFrame(columns=["timestamp"] + list(selected_metrics))
+# Built once so SQLAlchemy's compiled cache entry is reused on every call;
+# players and metrics are expanding bind params, not inlined literals.
+# NULL values are filtered here: pivot_table would only drop them anyway
+_WIDE_STMT = text(f"""
+	SELECT playername, timestamp, metric, {VALUE_COL} AS value
+	FROM {TABLE}
+	WHERE playername IN :players
+	  AND metric IN :metrics
+	  AND {VALUE_COL} IS NOT NULL
+	ORDER BY playername, timestamp;
+""").bindparams(
+	bindparam("players", expanding=True),
+	METRICS_PARAM,
+)
+
+# Wide-frame column dtypes, pinned so fresh, empty and cached frames all match
+# (metric columns are Arrow-backed, like the streamed reads)
+WIDE_TIMESTAMP_DTYPE = "datetime64[ns]"
+WIDE_VALUE_DTYPE = "double[pyarrow]"
+
+def _wide_cache_path(player_name, selected_metrics):
+	return cache_path(TABLE, player_name, tuple(selected_metrics), prefix="wide_")
+
+def long_to_wide_for_players(player_names, selected_metrics, conn):
+	player_names = list(dict.fromkeys(player_names))
+	columns = ["timestamp"] + list(selected_metrics)
+	wides = {}
+
+	# Reuse fresh cached frames; only the remaining players are queried
+	for p in player_names:
+		wide = read_cached(_wide_cache_path(p, selected_metrics))
+		if wide is not None:
+			wides[p] = wide
+
+	to_fetch = [p for p in player_names if p not in wides]
+	if not to_fetch:
+		return wides
+
+	# One query for every requested player instead of one per player
+	df = _read_sql_streamed(
+		_WIDE_STMT,
+		conn,
+		params={"players": to_fetch, "metrics": list(selected_metrics)},
+		parse_dates=["timestamp"],
+	)
 
-	df["timestamp"] = pd.to_datetime(df["timestamp"])
+	if not df.empty:
+		df = _as_category(df)
 
-	wide = (
-		df.pivot_table(
-			index="timestamp",
+		wide_all = df.pivot_table(
+			index=["playername", "timestamp"],
 			columns="metric",
 			values="value",
-			aggfunc="mean"
+			aggfunc="mean",
+			observed=True
 		)
-		.reset_index()
-		.sort_values("timestamp")
-	)
-
-	# ensure all chosen metrics appear
-	for m in selected_metrics:
-		if m not in wide.columns:
-			wide[m] = pd.NA
 
-	return wide[["timestamp"] + list(selected_metrics)]
-
-def test_long_to_wide_on_three_players(selected_metrics):
+		for player, wide in wide_all.groupby(level="playername", observed=True):
+			wide = (
+				wide.droplevel("playername")
+				    .sort_index()
+				    .reset_index()
+				    .astype({"timestamp": WIDE_TIMESTAMP_DTYPE})
+			)
+
+			# ensure all chosen metrics appear (typed like the pivoted columns,
+			# so they survive the Parquet round trip unchanged)
+			for m in selected_metrics:
+				if m not in wide.columns:
+					wide[m] = pd.Series(pd.NA, index=wide.index, dtype=WIDE_VALUE_DTYPE)
+
+			# plain column labels, so fresh and cached frames compare equal
+			wides[player] = wide[columns].rename_axis(columns=None)
+
+	for p in to_fetch:
+		if p not in wides:
+			wides[p] = pd.DataFrame({
+				"timestamp": pd.Series(dtype=WIDE_TIMESTAMP_DTYPE),
+				**{m: pd.Series(dtype=WIDE_VALUE_DTYPE) for m in selected_metrics},
+			})
+		write_cached(wides[p], _wide_cache_path(p, selected_metrics))
+
+	return wides
+
+def pick_sample_players(coverage):
+	# Player/team pairs come from the shared coverage frame, no extra query;
+	# one player from each of the first three teams
+	players = coverage[["playername", "team"]].drop_duplicates()
+	return players.drop_duplicates("team").head(3)
+
+def test_long_to_wide_on_three_players(sample, wides):
 	print("\n===== PART 2.2 — Long → Wide Transformation =====")
 
-	metrics_sql = _build_metrics_in_clause(selected_metrics)
-
-	q_players = f"""
-		SELECT DISTINCT playername, team
-		FROM {TABLE}
-		WHERE metric IN {metrics_sql}
-		  AND playername IS NOT NULL AND TRIM(playername) <> ''
-		  AND team IS NOT NULL AND TRIM(team) <> ''
-		LIMIT 200;
-	"""
-	players = pd.read_sql(q_players, engine)
-
-	if players.empty:
+	if sample.empty:
 		print("No players found for these metrics.")
 		return
 
-	sample = players.drop_duplicates("team").head(3)
-
 	for _, row in sample.iterrows():
 		p = row["playername"]
 		t = row["team"]
-		wide = long_to_wide_for_player(p, selected_metrics)
+		wide = wides[p]
+		if wide.empty:
+			print(f"\nNo data for player {p}.")
 		print(f"\nPlayer: {p} | Team: {t}")
 		print(wide.head())
 
@@ -208,40 +327,64 @@ def test_long_to_wide_on_three_players(selected_metrics):
 # 2.3 — DERIVED METRICS (TEAM COMPARISON)
 # ------------------------------------------------
 
-def derived_metric_analysis(selected_metrics):
-	print("\n===== PART 2.3 — Derived Team Metrics =====")
-
-	metrics_sql = _build_metrics_in_clause(selected_metrics)
-
-	q = f"""
-		SELECT playername, team, metric, timestamp, {VALUE_COL} AS value
+def load_team_relative(selected_metrics, conn):
+	# Team mean + SD per row via window functions, computed in MySQL
+	q_scored = f"""
+		SELECT
+			id,
+			playername,
+			team,
+			metric,
+			{VALUE_COL} AS value,
+			AVG({VALUE_COL}) OVER (PARTITION BY team, metric) AS team_mean,
+			STDDEV_POP({VALUE_COL}) OVER (PARTITION BY team, metric) AS team_sd
 		FROM {TABLE}
-		WHERE metric IN {metrics_sql}
+		WHERE metric IN :metrics
+		  AND {VALUE_COL} IS NOT NULL
 		  AND playername IS NOT NULL AND TRIM(playername) <> ''
-		  AND team IS NOT NULL AND TRIM(team) <> '';
+		  AND team IS NOT NULL AND TRIM(team) <> ''
 	"""
-	df = pd.read_sql(q, engine)
 
-	if df.empty:
-		print("No rows found.")
-		return
+	# % difference above/below team mean, averaged per athlete
+	q_summary = f"""
+		SELECT
+			team,
+			playername,
+			metric,
+			AVG((value - team_mean) / NULLIF(team_mean, 0)) * 100 AS avg_pct_diff
+		FROM ({q_scored}) AS scored
+		GROUP BY team, playername, metric;
+	"""
+	athlete_summary = pd.read_sql(
+		_metrics_query(q_summary), conn, params={"metrics": list(selected_metrics)}
+	)
 
-	df["timestamp"] = pd.to_datetime(df["timestamp"])
-	df = df.dropna(subset=["value"])
+	# optional: z-scores (SD of 0 falls back to 1, same as before); the window
+	# subquery comes back in partition order, so the first 10 rows are taken
+	# in table (id) order explicitly
+	q_z = f"""
+		SELECT
+			playername,
+			team,
+			metric,
+			value,
+			(value - team_mean) / COALESCE(NULLIF(team_sd, 0), 1) AS z_score
+		FROM ({q_scored}) AS scored
+		ORDER BY id
+		LIMIT 10;
+	"""
+	z_scores = pd.read_sql(
+		_metrics_query(q_z), conn, params={"metrics": list(selected_metrics)}
+	)
 
-	# team averages
-	df["team_metric_mean"] = df.groupby(["team", "metric"])["value"].transform("mean")
+	return athlete_summary, z_scores
 
-	# % difference above/below team mean
-	df["pct_diff_team_mean"] = (
-		(df["value"] - df["team_metric_mean"]) / df["team_metric_mean"] * 100
-	)
+def derived_metric_analysis(athlete_summary, z_scores):
+	print("\n===== PART 2.3 — Derived Team Metrics =====")
 
-	athlete_summary = (
-		df.groupby(["team", "playername", "metric"])["pct_diff_team_mean"]
-		  .mean()
-		  .reset_index(name="avg_pct_diff")
-	)
+	if athlete_summary.empty:
+		print("No rows found.")
+		return
 
 	top5 = athlete_summary.sort_values("avg_pct_diff", ascending=False).head(5)
 	bottom5 = athlete_summary.sort_values("avg_pct_diff", ascending=True).head(5)
@@ -252,22 +395,41 @@ def derived_metric_analysis(selected_metrics):
 	print("\nBottom 5 performers (% BELOW team mean):")
 	print(bottom5)
 
-	# optional: z-scores
-	df["z_score"] = df.groupby(["team", "metric"])["value"].transform(
-		lambda x: (x - x.mean()) / (x.std(ddof=0) or 1)
-	)
-
 	print("\nExample z-scores (first 10 rows):")
-	print(df[["playername", "team", "metric", "value", "z_score"]].head(10))
+	print(z_scores)
 
 # ------------------------------------------------
 # Wrapper to run all of Part 2
 # ------------------------------------------------
 
+def _on_own_connection(load, *args):
+	# Each worker thread checks out its own pooled connection
+	with engine.connect() as conn:
+		return load(*args, conn)
+
 def run_part2(selected_metrics):
-	missing_data_analysis(selected_metrics)
-	test_long_to_wide_on_three_players(selected_metrics)
-	derived_metric_analysis(selected_metrics)
+	# The Part 2 reads are independent, so they run concurrently on separate
+	# pooled connections; the reports still print in 2.1 -> 2.2 -> 2.3 order
+	# once their data is in
+	with ThreadPoolExecutor(max_workers=3) as ex:
+		f_coverage = ex.submit(_on_own_connection, load_coverage, selected_metrics)
+		f_missing = ex.submit(_on_own_connection, load_missing_counts, selected_metrics)
+		f_derived = ex.submit(_on_own_connection, load_team_relative, selected_metrics)
+
+		# 2.2 only needs its sample players, so its read starts as soon as
+		# coverage is back while the other reads may still be running
+		coverage = f_coverage.result()
+		sample = pick_sample_players(coverage)
+		f_wides = ex.submit(
+			_on_own_connection,
+			long_to_wide_for_players,
+			sample["playername"],
+			selected_metrics,
+		)
+
+		missing_data_analysis(f_missing.result(), coverage)
+		test_long_to_wide_on_three_players(sample, f_wides.result())
+		derived_metric_analysis(*f_derived.result())
 
 if __name__ == "__main__":
     run_part2(SELECTED_METRICS)
@@ -1,8 +1,10 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import numpy as np
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
 from dotenv import load_dotenv
+from query_cache import cached
 from datetime import datetime, timedelta
 
 # Loading environment variables from .env file
@@ -40,6 +42,24 @@ INACTIVITY_DAYS = 30 # inactive if not tested in 30+ days
 TEAM_NORM_SD = 2 # outside 2 standard deviations from team mean
 ASYMMETRY_THRESHOLD = 0.10  # 10% left/right difference
 
+# Column layout every flag function returns, so the final concat lines up
+# column for column without reordering or filling in missing columns
+FLAG_COLUMNS = ["playername", "team", "metric", "flag_reason", "metric_value", "last_test_date"]
+
+# Rows fetched per round trip when streaming the initial load
+CHUNK_SIZE = 50000
+
+# Server-side cursor so the driver streams rows in CHUNK_SIZE batches instead
+# of buffering the whole result set; timestamps are parsed as each chunk is
+# built, so no separate to_datetime pass over the full frame is needed
+def read_sql_streamed(query, parse_dates=None):
+    with engine.connect() as conn:
+        stmt = text(query).execution_options(stream_results=True, max_row_buffer=CHUNK_SIZE)
+        return pd.concat(
+            pd.read_sql(stmt, conn, chunksize=CHUNK_SIZE, parse_dates=parse_dates),
+            ignore_index=True
+        )
+
 # Load data for selected metrics (only relevant metrics and non-null values)
 metrics_sql = "(" + ", ".join(f"'{m}'" for m in SELECTED_METRICS) + ")"
 query = f"""
@@ -50,110 +70,148 @@ query = f"""
       AND team IS NOT NULL
       AND value IS NOT NULL
 """
-df = pd.read_sql(query, engine)
+# Cached in .qcache/ (see query_cache.py), keyed by the SQL text
+df = cached(lambda: read_sql_streamed(query, parse_dates=["timestamp"]), query)
+
+# Few distinct teams/players/metrics: categorical codes make every groupby below
+# hash small integers instead of strings
+for col in ("metric", "team", "playername"):
+    df[col] = df[col].astype("category")
+
+# Team mean and SD per team/metric, taken from the same rows the team-norm
+# flag tests (pandas' std uses ddof=1)
+team_stats = df.groupby(["team", "metric"], observed=True)["value"].agg(team_mean="mean", team_std="std")
 
-# Makes sure timestamp column is in datetime format
-df["timestamp"] = pd.to_datetime(df["timestamp"])
+# Computed once and shared by the flags: the run's reference date and the
+# player/team pairs (a player listed under several teams keeps one row per team)
+TODAY = pd.Timestamp.today()
+PLAYER_TEAMS = df[["playername", "team"]].drop_duplicates()
 
 # Flagging functions:
 
 # Identifys athletes who have not been tested in more than cutoff_days
 def flag_inactivity(player_df, cutoff_days=INACTIVITY_DAYS):
-    last_test = player_df.groupby("playername")["timestamp"].max().reset_index()
-    cutoff = pd.Timestamp.today() - pd.Timedelta(days = cutoff_days)
+    last_test = player_df.groupby("playername", observed=True)["timestamp"].max()
+    cutoff = TODAY - pd.Timedelta(days = cutoff_days)
     # Flag players with last test before the cutoff date
-    inactive = last_test[last_test["timestamp"] < cutoff]
-    inactive["flag_reason"] = f"Inactive > {cutoff_days} days"
+    inactive = last_test[last_test < cutoff].rename("last_test_date").reset_index()
     # Add team info from original dataset
-    inactive = inactive.merge(df[["playername", "team"]].drop_duplicates(), on="playername", how="left")
-    # Metrics and values are NA for inactivity flags
-    inactive["metric"] = None
-    inactive["metric_value"] = None
-    inactive["last_test_date"] = inactive["timestamp"]
-    return inactive[["playername","team","metric","flag_reason","metric_value","last_test_date"]]
+    inactive = inactive.merge(PLAYER_TEAMS, on="playername", how="left")
+    # Metrics and values are NA for inactivity flags, typed like the other
+    # flags' columns so the final concat doesn't have to guess their dtype
+    return inactive.assign(
+        metric=pd.Categorical([None] * len(inactive), categories=player_df["metric"].cat.categories),
+        flag_reason=f"Inactive > {cutoff_days} days",
+        metric_value=np.nan
+    )[FLAG_COLUMNS]
 
 # Flag athletes who drops more than a threshold percentage of 10% from their rolling mean of the last 3 tests
 def flag_performance_decline(player_df, decline_threshold=DECLINE_THRESHOLD):
-    rows = []
-    for player in player_df["playername"].unique():
-        sub = player_df[player_df["playername"] == player].copy()
-        for metric in sub["metric"].unique():
-            metric_sub = sub[sub["metric"] == metric].sort_values("timestamp")
-            # Require at least 3 prior tests to calculate rolling mean
-            if len(metric_sub) < 3:
-                continue
-            # Rolling mean of last 3 tests
-            rolling_mean = metric_sub["value"].rolling(3).mean()
-            # Flag if latest value drops below threshold from rolling mean
-            latest_val = metric_sub["value"].iloc[-1]
-            # Avoid division by zero
-            if rolling_mean.iloc[-1] == 0:
-                continue
-            drop_pct = (rolling_mean.iloc[-1] - latest_val) / rolling_mean.iloc[-1]
-            # Flag if decline exceeds threshold
-            if drop_pct > decline_threshold:
-                rows.append({
-                    "playername": player,
-                    "team": metric_sub["team"].iloc[-1],
-                    "metric": metric,
-                    "flag_reason": f"Declined > {decline_threshold*100:.0f}%",
-                    "metric_value": latest_val,
-                    "last_test_date": metric_sub["timestamp"].iloc[-1]
-                })
-    return pd.DataFrame(rows)
+    keys = ["playername", "metric"]
+    # Number players, and each player's metrics, by first appearance so the
+    # flags come out in the same order as the original per-player loop
+    player_rank = player_df.groupby("playername", observed=True, sort=False).ngroup()
+    series_rank = player_df.groupby(keys, observed=True, sort=False).ngroup()
+    # Sort once so every player/metric series is contiguous and in time order
+    ordered = player_df.assign(_player_rank=player_rank, _series_rank=series_rank).sort_values(
+        ["_player_rank", "_series_rank", "timestamp"], kind="stable"
+    )
+    values = ordered["value"].to_numpy(dtype=float)
+    codes = ordered["_series_rank"].to_numpy()
+    # Position of the latest test in each series, and how many tests the series has
+    ends = np.flatnonzero(np.diff(codes, append=-1))
+    sizes = np.diff(ends, prepend=-1)
+    # Rolling mean of the last 3 tests only exists for series with 3+ tests
+    ends = ends[sizes >= 3]
+    rolling_mean = (values[ends - 2] + values[ends - 1] + values[ends]) / 3
+    latest = ordered.iloc[ends].assign(rolling_mean=rolling_mean)
+    # Avoid division by zero
+    latest = latest[latest["rolling_mean"] != 0]
+    drop_pct = (latest["rolling_mean"] - latest["value"]) / latest["rolling_mean"]
+    # Flag if decline exceeds threshold
+    flagged = latest[drop_pct > decline_threshold]
+    return pd.DataFrame({
+        "playername": flagged["playername"],
+        "team": flagged["team"],
+        "metric": flagged["metric"],
+        "flag_reason": f"Declined > {decline_threshold*100:.0f}%",
+        "metric_value": flagged["value"],
+        "last_test_date": flagged["timestamp"]
+    }, columns=FLAG_COLUMNS).reset_index(drop=True)
 
 # Identify athletes with metric values that are 2 SD outside the team mean
-def flag_team_norm(df, n_sd = TEAM_NORM_SD):
-    rows = []
-    for metric in df["metric"].unique():
-        metric_sub = df[df["metric"] == metric]
-        team_mean = metric_sub.groupby("team")["value"].transform("mean")
-        team_std = metric_sub.groupby("team")["value"].transform("std").replace(0, np.nan)
-        outliers = ((metric_sub["value"] - team_mean).abs() > n_sd * team_std)
-        flagged = metric_sub[outliers]
-        for _, row in flagged.iterrows():
-            rows.append({
-                "playername": row["playername"],
-                "team": row["team"],
-                "metric": row["metric"],
-                "flag_reason": f"Outside team norm ±{n_sd} SD",
-                "metric_value": row["value"],
-                "last_test_date": row["timestamp"]
-            })
-    return pd.DataFrame(rows)
+def flag_team_norm(df, team_stats, n_sd = TEAM_NORM_SD):
+    # Attach each row's team mean and SD from the pre-aggregated stats
+    stats = df[["team", "metric"]].join(team_stats, on=["team", "metric"])
+    team_mean = stats["team_mean"]
+    team_std = stats["team_std"].replace(0, np.nan)
+    outliers = ((df["value"] - team_mean).abs() > n_sd * team_std)
+    out = df.loc[outliers, ["playername", "team", "metric", "value", "timestamp"]].rename(
+        columns={"value": "metric_value", "timestamp": "last_test_date"}
+    )
+    # Keep the rows grouped by metric (first-appearance order), as the
+    # per-metric loop used to emit them
+    metric_rank = df.groupby("metric", observed=True, sort=False).ngroup()[outliers]
+    out = out.iloc[np.argsort(metric_rank.to_numpy(), kind="stable")]
+    out["flag_reason"] = f"Outside team norm ±{n_sd} SD"
+    return out[FLAG_COLUMNS].reset_index(drop=True)
 
 # Identify athletes with left/right asymmetry exceeding threshold for bilateral metrics (leftMaxForce vs rightMaxForce)
 def flag_asymmetry(df, threshold=ASYMMETRY_THRESHOLD):
-    rows = []
+    frames = []
     bilateral_pairs = [("leftMaxForce", "rightMaxForce")]
     for left, right in bilateral_pairs:
         sub = df[df["metric"].isin([left, right])]
-        for player in sub["playername"].unique():
-            player_sub = sub[sub["playername"] == player]
-            left_val = player_sub[player_sub["metric"] == left]["value"].mean()
-            right_val = player_sub[player_sub["metric"] == right]["value"].mean()
-            # Skip if either value is missing
-            if pd.isna(left_val) or pd.isna(right_val):
-                continue
-            diff = abs(left_val - right_val) / max(left_val, right_val)
-            if diff > threshold:
-                rows.append({
-                    "playername": player,
-                    "team": player_sub["team"].iloc[0],
-                    "metric": f"{left}/{right}",
-                    "flag_reason": f"Asymmetry > {threshold*100:.0f}%",
-                    "metric_value": f"{left_val:.2f}/{right_val:.2f}",
-                    "last_test_date": player_sub["timestamp"].max()
-                })
-    return pd.DataFrame(rows)
-
-# Apply flagging functions to data
-df_flags = pd.concat([
-    flag_inactivity(df),
-    flag_performance_decline(df),
-    flag_team_norm(df, n_sd = TEAM_NORM_SD),
-    flag_asymmetry(df)
-], ignore_index=True)
+        if sub.empty:
+            continue
+        # Number players by first appearance so flags come out in the original loop order
+        by_player = sub.groupby("playername", observed=True, sort=False)
+        side = (sub["metric"] == right).to_numpy().astype(np.int64)
+        ordered = sub.assign(_key=by_player.ngroup() * 2 + side).sort_values("_key", kind="stable")
+        keys = ordered["_key"].to_numpy()
+        # One contiguous segment per player/side. Each mean is a plain NumPy
+        # mean of its segment (pairwise sum), the same arithmetic as Series.mean(),
+        # so the 2-decimal strings don't drift at .xx5 ties the way groupby's
+        # compensated mean or a sequential reduceat sum would
+        starts = np.flatnonzero(np.diff(keys, prepend=-1))
+        segments = np.split(ordered["value"].to_numpy(dtype=float), starts[1:])
+        means = np.array([seg.mean() for seg in segments])
+        seg_player, seg_side = keys[starts] // 2, keys[starts] % 2
+        # A left segment followed by a right one for the same player (skips players missing either side)
+        left_idx = np.flatnonzero((seg_side[:-1] == 0) & (seg_player[1:] == seg_player[:-1]))
+        left_mean, right_mean = means[left_idx], means[left_idx + 1]
+        diff = np.abs(left_mean - right_mean) / np.maximum(left_mean, right_mean)
+        hit = diff > threshold
+        players = ordered["playername"].to_numpy()[starts[left_idx][hit]]
+        out = pd.DataFrame({
+            "playername": players,
+            "team": by_player["team"].first().reindex(players).to_numpy(),
+            "metric": f"{left}/{right}",
+            "flag_reason": f"Asymmetry > {threshold*100:.0f}%",
+            "metric_value": [f"{l:.2f}/{r:.2f}" for l, r in zip(left_mean[hit], right_mean[hit])],
+            "last_test_date": by_player["timestamp"].max().reindex(players).to_numpy()
+        })
+        frames.append(out[FLAG_COLUMNS])
+    if not frames:
+        return pd.DataFrame(columns=FLAG_COLUMNS)
+    return pd.concat(frames, ignore_index=True)
+
+# Apply flagging functions to data: they only read df, so they run side by
+# side on threads (much of the groupby/NumPy work runs outside the GIL)
+with ThreadPoolExecutor(max_workers=4) as pool:
+    futures = [
+        pool.submit(flag_inactivity, df),
+        pool.submit(flag_performance_decline, df),
+        pool.submit(flag_team_norm, df, team_stats, n_sd = TEAM_NORM_SD),
+        pool.submit(flag_asymmetry, df)
+    ]
+    results = [f.result() for f in futures]
+
+# Leave out flags that found nothing, so an empty section doesn't decide column dtypes
+df_flags = pd.concat(
+    [r for r in results if not r.empty] or [pd.DataFrame(columns=FLAG_COLUMNS)],
+    ignore_index=True
+)
 
 # Export results to CSV
 df_flags.to_csv("part4_flagged_athletes.csv", index=False)
@@ -0,0 +1,42 @@
+import os
+import time
+import hashlib
+import threading
+from pathlib import Path
+import pandas as pd
+
+# Local query-result cache shared by the part scripts (Parquet files in .qcache/)
+CACHE_DIR = Path(".qcache")
+CACHE_TTL = 3600  # seconds before a cached result is re-queried
+
+# Path of the cache file for key_parts (SQL text, params, player, ...).
+# The database server and name are part of every key: .qcache/ is shared by
+# all scripts, so results from one database are never served once .env
+# points at another
+def cache_path(*key_parts, prefix=""):
+    key_src = repr((os.getenv("db_hostname"), os.getenv("db_database")) + key_parts)
+    key = hashlib.sha1(key_src.encode()).hexdigest()
+    return CACHE_DIR / f"{prefix}{key}.parquet"
+
+# Cached frame at path, or None when it is missing or older than ttl
+def read_cached(path, ttl=CACHE_TTL):
+    if path.exists() and time.time() - path.stat().st_mtime < ttl:
+        return pd.read_parquet(path)
+    return None
+
+# Written to a temp file and moved into place, so an interrupted run never
+# leaves a truncated file behind that still looks fresh
+def write_cached(df, path):
+    CACHE_DIR.mkdir(exist_ok=True)
+    tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+    df.to_parquet(tmp, index=False)
+    os.replace(tmp, path)
+
+# Fresh cached frame for key_parts, otherwise load() and cache its result
+def cached(load, *key_parts, ttl=CACHE_TTL):
+    path = cache_path(*key_parts)
+    df = read_cached(path, ttl)
+    if df is None:
+        df = load()
+        write_cached(df, path)
+    return df